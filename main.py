@@ -1,18 +1,37 @@
 import os
+import io
 import asyncio
 import logging
+import re
 import json
-import requests
-from datetime import datetime
+import time
+import sqlite3
+import itertools
+import hashlib
+import math
+from array import array
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+try:
+    import orjson
+except ImportError:
+    orjson = None
+import httpx
+from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from telegram import Update, Bot
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
-from github import Github
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from telegram import Update
+from telegram.error import RetryAfter
+from telegram.ext import AIORateLimiter, ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
 import google.generativeai as genai
+from google.generativeai import caching
+from google import genai as google_genai
 from duckduckgo_search import DDGS
-from pydub import AudioSegment
-import speech_recognition as sr
+import av
+from faster_whisper import WhisperModel
+from faster_whisper.audio import decode_audio
 
 # Configure logging
 logging.basicConfig(
@@ -29,31 +48,328 @@ GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 INCLUDE_PRIVATE = os.getenv('INCLUDE_PRIVATE', 'false').lower() == 'true'
 TARGET_REPOS = os.getenv('TARGET_REPOS', '').split(',') if os.getenv('TARGET_REPOS') else []
 STATE_FILE = 'reviewed_state.json'
+GITHUB_API = 'https://api.github.com'
+GITHUB_GRAPHQL = 'https://api.github.com/graphql'
+MAX_REPO_CANDIDATES = 10
+GITHUB_SCAN_CONCURRENCY = 5
+GEMINI_SCAN_CONCURRENCY = 3
+# Asking the PR endpoint for this media type returns the raw diff
+DIFF_HEADERS = {"Accept": "application/vnd.github.v3.diff"}
 HISTORY_FILE = 'chat_history.json'
+HISTORY_BACKUP_FILE = 'chat_history.backup.json'
+DB_FILE = 'analyzer.db'
+MAX_SESSION_MESSAGES = 20
+# Seconds between progressive edits of a streamed reply (Telegram throttles edits)
+STREAM_EDIT_INTERVAL = 1.0
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Scheduled checks go through the Batch API when set (e.g. gemini-2.5-flash)
+GEMINI_BATCH_MODEL = os.getenv('GEMINI_BATCH_MODEL')
+BATCH_POLL_MINUTES = 5
+# Opt-in explicit context caching of the PR review instructions
+ENABLE_GEMINI_CACHE = os.getenv('ENABLE_GEMINI_CACHE', 'false').lower() == 'true'
+GEMINI_CACHE_MODEL = os.getenv('GEMINI_CACHE_MODEL', 'models/gemini-2.5-flash')
+GEMINI_CACHE_TTL = timedelta(hours=1)
+# Opt-in reuse of reviews for near-identical diffs in the same repo
+ENABLE_SEMANTIC_CACHE = os.getenv('ENABLE_SEMANTIC_CACHE', 'false').lower() == 'true'
+EMBEDDING_MODEL = 'models/text-embedding-004'
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_TTL = timedelta(hours=24)
+# Local speech-to-text model for voice notes (int8 on CPU)
+WHISPER_MODEL = os.getenv('WHISPER_MODEL', 'small.en')
 
-# --- History Management ---
-def load_history():
-    if os.path.exists(HISTORY_FILE):
+# --- Storage ---
+# Every update is a single-row write instead of rewriting a whole JSON file.
+# The current chat session is stored under the empty session name.
+CURRENT_SESSION = ""
+
+db = sqlite3.connect(DB_FILE)
+db.execute("PRAGMA journal_mode=WAL")
+# In WAL mode NORMAL only fsyncs at checkpoints; a power loss can drop the
+# last few commits but never corrupts the database.
+db.execute("PRAGMA synchronous=NORMAL")
+db.executescript("""
+CREATE TABLE IF NOT EXISTS reviewed (
+    pr_id TEXT PRIMARY KEY,
+    sha TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS etags (
+    url TEXT PRIMARY KEY,
+    etag TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS semantic_cache (
+    repo TEXT NOT NULL,
+    pr_id TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    analysis TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS semantic_cache_repo ON semantic_cache (repo, ts);
+CREATE TABLE IF NOT EXISTS history (
+    chat_id TEXT NOT NULL,
+    session TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    message_id INTEGER,
+    PRIMARY KEY (chat_id, session, idx)
+);
+""")
+
+# Bumped when a one-off data migration runs; stored in PRAGMA user_version
+SCHEMA_VERSION = 1
+
+def read_json(path):
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read()) if orjson else json.load(f)
+
+def read_legacy_json(path):
+    try:
+        return read_json(path)
+    except json.JSONDecodeError as e:  # orjson's error subclasses this
+        logger.error(f"Skipping unreadable {path}: {e}")
+        return {}
+
+def import_legacy_files():
+    """One-shot upgrade from the old JSON files, run once at startup before polling."""
+    (version,) = db.execute("PRAGMA user_version").fetchone()
+    if version >= SCHEMA_VERSION:
+        return
+
+    with db:
+        if os.path.exists(STATE_FILE):
+            db.executemany("INSERT OR REPLACE INTO reviewed VALUES (?, ?)", read_legacy_json(STATE_FILE).items())
+            logger.info(f"Imported {STATE_FILE} into {DB_FILE}")
+
+        if os.path.exists(HISTORY_FILE):
+            for chat_id, user_data in read_legacy_json(HISTORY_FILE).items():
+                # The oldest format stored the current session as a bare list
+                if isinstance(user_data, list):
+                    user_data = {"current_session": user_data, "saved_sessions": {}}
+                sessions = {CURRENT_SESSION: user_data.get("current_session", [])}
+                sessions.update(user_data.get("saved_sessions", {}))
+                for session, msgs in sessions.items():
+                    db.executemany(
+                        "INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?)",
+                        [(chat_id, session, i, m["role"], m["content"], m.get("id")) for i, m in enumerate(msgs)],
+                    )
+            logger.info(f"Imported {HISTORY_FILE} into {DB_FILE}")
+
+        db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    for path in (STATE_FILE, HISTORY_FILE):
+        if os.path.exists(path):
+            os.replace(path, path + ".migrated")
+
+# Reviewed SHAs mirrored in memory; read from disk once, then kept in sync
+# by mark_reviewed.
+_STATE_CACHE = None
+
+def load_state():
+    global _STATE_CACHE
+    if _STATE_CACHE is None:
+        _STATE_CACHE = dict(db.execute("SELECT pr_id, sha FROM reviewed"))
+    return _STATE_CACHE
+
+def mark_reviewed(pr_id, sha):
+    with db:
+        db.execute("INSERT OR REPLACE INTO reviewed VALUES (?, ?)", (pr_id, sha))
+    load_state()[pr_id] = sha
+
+def get_etag(url):
+    row = db.execute("SELECT etag FROM etags WHERE url = ?", (url,)).fetchone()
+    return row[0] if row else None
+
+def save_etag(url, etag):
+    with db:
+        db.execute("INSERT OR REPLACE INTO etags VALUES (?, ?)", (url, etag))
+
+def find_similar_analysis(repo, embedding):
+    """Returns the freshest stored analysis in `repo` whose diff embedding is close enough, if any.
+
+    Embeddings are stored unit-normalized, so the dot product is the cosine similarity.
+    """
+    best, best_score = None, SEMANTIC_CACHE_THRESHOLD
+    cutoff = time.time() - SEMANTIC_CACHE_TTL.total_seconds()
+    rows = db.execute("SELECT embedding, analysis FROM semantic_cache WHERE repo = ? AND ts >= ?", (repo, cutoff))
+    for blob, analysis in rows:
+        score = sum(x * y for x, y in zip(array('f', blob), embedding))
+        if score >= best_score:
+            best, best_score = analysis, score
+    return best
+
+def store_analysis_embedding(repo, pr_id, embedding, analysis):
+    cutoff = time.time() - SEMANTIC_CACHE_TTL.total_seconds()
+    with db:
+        db.execute("DELETE FROM semantic_cache WHERE ts < ?", (cutoff,))
+        db.execute(
+            "INSERT INTO semantic_cache VALUES (?, ?, ?, ?, ?)",
+            (repo, pr_id, array('f', embedding).tobytes(), analysis, time.time()),
+        )
+
+def has_history(chat_id):
+    return db.execute("SELECT 1 FROM history WHERE chat_id = ? LIMIT 1", (chat_id,)).fetchone() is not None
+
+def get_session(chat_id, session=CURRENT_SESSION):
+    rows = db.execute(
+        "SELECT role, content, message_id FROM history WHERE chat_id = ? AND session = ? ORDER BY idx",
+        (chat_id, session),
+    )
+    return [{"role": role, "content": content, "id": msg_id} for role, content, msg_id in rows]
+
+# Current sessions kept in memory, loaded lazily from the database
+HISTORY_CACHE = {}
+
+def current_session(chat_id):
+    """Returns the cached current session of a chat as a bounded deque."""
+    if chat_id not in HISTORY_CACHE:
+        HISTORY_CACHE[chat_id] = deque(get_session(chat_id), maxlen=MAX_SESSION_MESSAGES)
+    return HISTORY_CACHE[chat_id]
+
+def append_messages(chat_id, messages):
+    """Appends turns to the current session in one transaction and trims it to MAX_SESSION_MESSAGES."""
+    with db:
+        (start,) = db.execute(
+            "SELECT COALESCE(MAX(idx), -1) + 1 FROM history WHERE chat_id = ? AND session = ?",
+            (chat_id, CURRENT_SESSION),
+        ).fetchone()
+        db.executemany(
+            "INSERT INTO history VALUES (?, ?, ?, ?, ?, ?)",
+            [(chat_id, CURRENT_SESSION, start + i, m["role"], m["content"], m["id"]) for i, m in enumerate(messages)],
+        )
+        db.execute(
+            "DELETE FROM history WHERE chat_id = ? AND session = ? AND idx < ?",
+            (chat_id, CURRENT_SESSION, start + len(messages) - MAX_SESSION_MESSAGES),
+        )
+    if chat_id in HISTORY_CACHE:
+        HISTORY_CACHE[chat_id].extend(messages)
+
+def copy_session(chat_id, source, target):
+    """Replaces session `target` with a copy of session `source`."""
+    with db:
+        db.execute("DELETE FROM history WHERE chat_id = ? AND session = ?", (chat_id, target))
+        db.execute(
+            "INSERT INTO history SELECT chat_id, ?, idx, role, content, message_id FROM history WHERE chat_id = ? AND session = ?",
+            (target, chat_id, source),
+        )
+    if target == CURRENT_SESSION:
+        HISTORY_CACHE.pop(chat_id, None)
+
+def delete_session(chat_id, session=CURRENT_SESSION):
+    if session == CURRENT_SESSION:
+        HISTORY_CACHE.pop(chat_id, None)
+    with db:
+        return db.execute("DELETE FROM history WHERE chat_id = ? AND session = ?", (chat_id, session)).rowcount
+
+def session_exists(chat_id, session):
+    return db.execute(
+        "SELECT 1 FROM history WHERE chat_id = ? AND session = ? LIMIT 1", (chat_id, session)
+    ).fetchone() is not None
+
+def list_sessions(chat_id):
+    rows = db.execute(
+        "SELECT DISTINCT session FROM history WHERE chat_id = ? AND session != ? ORDER BY session",
+        (chat_id, CURRENT_SESSION),
+    )
+    return [session for (session,) in rows]
+
+def delete_chat(chat_id):
+    HISTORY_CACHE.pop(chat_id, None)
+    with db:
+        db.execute("DELETE FROM history WHERE chat_id = ?", (chat_id,))
+
+async def snapshot_history():
+    """Backs up all sessions to HISTORY_BACKUP_FILE in the old chat_history.json layout.
+
+    A coroutine so the scheduler runs it on the loop thread, which owns the db connection.
+    """
+    backup = {}
+    rows = db.execute("SELECT chat_id, session, role, content, message_id FROM history ORDER BY chat_id, session, idx")
+    for chat_id, session, role, content, msg_id in rows:
+        user_data = backup.setdefault(chat_id, {"current_session": [], "saved_sessions": {}})
+        if session == CURRENT_SESSION:
+            msgs = user_data["current_session"]
+        else:
+            msgs = user_data["saved_sessions"].setdefault(session, [])
+        msgs.append({"role": role, "content": content, "id": msg_id})
+    await asyncio.to_thread(write_json_atomic, HISTORY_BACKUP_FILE, backup)
+
+def write_json_atomic(path, data):
+    """Writes JSON to a temp file and swaps it in, so a crash never leaves a truncated file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        if orjson:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        else:
+            f.write(json.dumps(data, indent=2).encode())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# --- GitHub Client ---
+class RateLimitedClient:
+    """httpx.AsyncClient wrapper that respects GitHub's rate limit headers."""
+
+    def __init__(self, max_concurrency=64, max_retries=5, min_remaining=5, **client_kwargs):
+        self._client = httpx.AsyncClient(**client_kwargs)
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._ready = asyncio.Event()
+        self._ready.set()
+        self.max_retries = max_retries
+        self.min_remaining = min_remaining
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def request(self, method, url, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            await self._ready.wait()
+            async with self._sem:
+                resp = await self._client.request(method, url, **kwargs)
+
+            if self._is_rate_limited(resp) and attempt < self.max_retries:
+                delay = max(self._retry_delay(resp), 2 ** attempt)
+                logger.warning(f"GitHub rate limited ({resp.status_code}), retrying in {delay:.0f}s")
+                await self._pause(delay)
+                continue
+
+            remaining = resp.headers.get("X-RateLimit-Remaining")
+            if remaining is not None and int(remaining) < self.min_remaining:
+                await self._pause(self._retry_delay(resp))
+            return resp
+        return resp
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    @staticmethod
+    def _is_rate_limited(resp):
+        if resp.status_code == 429:
+            return True
+        return resp.status_code == 403 and (
+            "Retry-After" in resp.headers or resp.headers.get("X-RateLimit-Remaining") == "0"
+        )
+
+    @staticmethod
+    def _retry_delay(resp):
+        if "Retry-After" in resp.headers:
+            return float(resp.headers["Retry-After"])
+        if "X-RateLimit-Reset" in resp.headers:
+            return max(float(resp.headers["X-RateLimit-Reset"]) - time.time(), 0)
+        return 0
+
+    async def _pause(self, delay):
+        """Blocks every caller until the backoff window has passed."""
+        if not self._ready.is_set():
+            await self._ready.wait()
+            return
+        self._ready.clear()
         try:
-            with open(HISTORY_FILE, 'r') as f:
-                data = json.load(f)
-                migrated_data = {}
-                for chat_id, content in data.items():
-                    if isinstance(content, list):
-                        migrated_data[chat_id] = {
-                            "current_session": content,
-                            "saved_sessions": {}
-                        }
-                    else:
-                        migrated_data[chat_id] = content
-                return migrated_data
-        except json.JSONDecodeError:
-            return {}
-    return {}
-
-def save_history(history):
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(history, f, indent=2)
+            await asyncio.sleep(delay)
+        finally:
+            self._ready.set()
 
 # Initialize Clients
 if not all([GITHUB_TOKEN, TELEGRAM_TOKEN, TELEGRAM_CHAT_ID, GOOGLE_API_KEY]):
@@ -63,135 +379,772 @@ if not all([GITHUB_TOKEN, TELEGRAM_TOKEN, TELEGRAM_CHAT_ID, GOOGLE_API_KEY]):
 genai.configure(api_key=GOOGLE_API_KEY)
 # Using Gemma for text (High Quota)
 model = genai.GenerativeModel('gemma-3-27b-it')
+batch_client = google_genai.Client(api_key=GOOGLE_API_KEY) if GEMINI_BATCH_MODEL else None
+
+# Batch polls are persisted so results submitted before a restart are still delivered.
+# A run that is already in progress is never started again, and late runs are merged.
+scheduler = AsyncIOScheduler(
+    jobstores={"default": MemoryJobStore(), "batches": SQLAlchemyJobStore(url=f"sqlite:///{DB_FILE}")},
+    job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 300},
+)
+# The application's bot, set on startup so scheduled jobs share its connection pool and rate limiter
+telegram_bot = None
 
-gh = Github(GITHUB_TOKEN)
+github = RateLimitedClient(
+    http2=True,
+    # Keep idle TLS connections around while scans wait on Gemini (httpx default is 5s)
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=120),
+    headers={
+        "Authorization": f"Bearer {GITHUB_TOKEN}",
+        "Accept": "application/vnd.github+json",
+    },
+    follow_redirects=True,
+    timeout=30.0,
+)
 
 # --- Helper Functions ---
 
-def perform_web_search(query, max_results=3):
-    """Searches the web using DuckDuckGo."""
+# query -> (fetched_at, formatted results); one DDGS keeps its HTTP session across searches
+SEARCH_CACHE = OrderedDict()
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_TTL = 600
+ddgs = DDGS()
+
+async def perform_web_search(query, max_results=3):
+    """Searches the web using DuckDuckGo, reusing results for repeated queries within 10 minutes."""
+    key = (query.strip().lower(), max_results)
+    cached = SEARCH_CACHE.get(key)
+    if cached and time.monotonic() - cached[0] < SEARCH_CACHE_TTL:
+        SEARCH_CACHE.move_to_end(key)
+        return cached[1]
     try:
-        results = DDGS().text(query, max_results=max_results)
-        if not results:
-            return "No results found."
-        
-        formatted_results = ""
-        for r in results:
-            formatted_results += f"- [{r['title']}]({r['href']}): {r['body']}\n"
-        return formatted_results
+        # The client is synchronous, so keep it off the event loop
+        results = await asyncio.to_thread(ddgs.text, query, max_results=max_results)
     except Exception as e:
         logger.error(f"Search error: {e}")
         return f"Error performing search: {e}"
+    if not results:
+        formatted_results = "No results found."
+    else:
+        formatted_results = "".join(f"- [{r['title']}]({r['href']}): {r['body']}\n" for r in results)
+    SEARCH_CACHE[key] = (time.monotonic(), formatted_results)
+    SEARCH_CACHE.move_to_end(key)
+    if len(SEARCH_CACHE) > SEARCH_CACHE_SIZE:
+        SEARCH_CACHE.popitem(last=False)
+    return formatted_results
 
-# --- State Management ---
-def load_state():
-    if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+# url -> (etag, data, next_url) for responses revalidated with If-None-Match
+_ETAG_CACHE = {}
 
-def save_state(state):
-    with open(STATE_FILE, 'w') as f:
-        json.dump(state, f, indent=2)
+async def fetch_json_page(session, url, params=None, revalidate=False):
+    """GETs one page of JSON and returns it with the URL of the next page.
+
+    With `revalidate`, the response is kept in memory and reused when GitHub
+    answers 304 Not Modified, which doesn't count against the rate limit.
+    """
+    url = str(httpx.URL(url).copy_merge_params(params)) if params else url
+    cached = _ETAG_CACHE.get(url) if revalidate else None
+    resp = await session.get(url, headers={"If-None-Match": cached[0]} if cached else None)
+    if cached and resp.status_code == 304:
+        return cached[1], cached[2]
+    resp.raise_for_status()
+    data = resp.json()
+    next_url = resp.links.get("next", {}).get("url")
+    if revalidate and "ETag" in resp.headers:
+        _ETAG_CACHE[url] = (resp.headers["ETag"], data, next_url)
+    return data, next_url
+
+async def fetch_json(session, url, params=None, revalidate=False):
+    data, _ = await fetch_json_page(session, url, params, revalidate)
+    return data
+
+async def fetch_text(session, url, headers=None):
+    resp = await session.get(url, headers=headers)
+    resp.raise_for_status()
+    return resp.text
+
+async def fetch_all_pages(session, url, params=None, revalidate=False):
+    """Follows GitHub's Link headers and returns every item of a list endpoint."""
+    items = []
+    params = {**(params or {}), "per_page": 100}
+    while url:
+        page, url = await fetch_json_page(session, url, params, revalidate)
+        items.extend(page)
+        params = None  # The "next" link already carries the query string
+    return items
+
+# --- Repo Index ---
+# Maps lowercased "name" and "owner/name" to full names of the user's repos,
+# so chat messages can be matched without probing GitHub word by word.
+REPO_INDEX = {}
+REPO_INDEX_TTL = 600
+REPO_TOKEN_RE = re.compile(r"[\w.-]+(?:/[\w.-]+)?")
+# Explicit "owner/name" mentions, also inside github.com URLs; GitHub logins are alphanumerics and hyphens
+REPO_SLUG_RE = re.compile(r"(?<![\w./-])(?:(?:https?://)?(?:www\.)?github\.com/)?([A-Za-z0-9][A-Za-z0-9-]{0,38}/[\w.-]+)")
+_repo_index_built_at = 0.0
+_repo_index_task = None
+
+async def refresh_repo_index():
+    global _repo_index_built_at
+    repos = await fetch_all_pages(github, f"{GITHUB_API}/user/repos", {"sort": "updated"}, revalidate=True)
+    index = {}
+    for repo in repos:
+        # Most recently updated repo wins when names collide across owners
+        index.setdefault(repo["name"].lower(), repo["full_name"])
+        index[repo["full_name"].lower()] = repo["full_name"]
+    REPO_INDEX.clear()
+    REPO_INDEX.update(index)
+    _repo_index_built_at = time.monotonic()
+    logger.info(f"Indexed {len(repos)} repositories")
+
+async def _refresh_repo_index_quietly():
+    try:
+        await refresh_repo_index()
+    except Exception as e:
+        logger.error(f"Repo index refresh failed: {e}")
+
+async def get_repo_index():
+    """Returns the repo index, building it on first use and refreshing it in the background once stale."""
+    global _repo_index_task
+    if not _repo_index_built_at:
+        await refresh_repo_index()
+    elif time.monotonic() - _repo_index_built_at > REPO_INDEX_TTL and (_repo_index_task is None or _repo_index_task.done()):
+        _repo_index_task = asyncio.create_task(_refresh_repo_index_quietly())
+    return REPO_INDEX
+
+async def find_first_repo(candidates):
+    """Resolves "owner/name" candidates in one GraphQL query and returns the first that exists."""
+    fields = []
+    for i, candidate in enumerate(candidates):
+        owner, name = candidate.split("/", 1)
+        fields.append(f"r{i}: repository(owner: {json.dumps(owner)}, name: {json.dumps(name)}) {{ nameWithOwner }}")
+    resp = await github.post(GITHUB_GRAPHQL, json={"query": "query { " + " ".join(fields) + " }"})
+    resp.raise_for_status()
+    # Missing repos come back as null aliases alongside NOT_FOUND errors
+    data = resp.json().get("data") or {}
+    for i in range(len(candidates)):
+        if data.get(f"r{i}"):
+            return data[f"r{i}"]["nameWithOwner"]
+    return None
+
+# --- Prompts ---
+# Static prefixes go first so Gemini's implicit cache can reuse them across calls.
+PR_REVIEW_INSTRUCTIONS = """
+You are a strict Senior Software Engineer reviewing a Pull Request.
+
+**Task:**
+Analyze the changes. Determine if this is a "Good Push" or "Bad Push".
+
+**Output Format (Markdown):**
+**Verdict:** [Good Push / Bad Push]
+
+**Summary:**
+[1-2 sentences]
+
+**Critique:**
+*   **Bad Practices:** [Security risks, dirty code, anti-patterns]
+*   **Issue Alignment:** [Does this solve the problem?]
+*   **Improvements:** [Specific suggestions]
+
+If it's a perfect push, explicitly state "No issues found."
+"""
+
+# Gemini only caches a shared prefix past ~1024 tokens, so models that cache
+# (the explicit review cache and the Batch API model) get this rubric on top of
+# the instructions. Gemma, the default model, doesn't cache and does without it.
+PR_REVIEW_RUBRIC = """
+**Review Rubric:**
+Work through every section below before deciding on a verdict. Only report
+findings that are supported by the diff; do not speculate about code you
+cannot see, and do not pad the critique with generic advice.
+
+1. Correctness
+   - Does the change do what the title and description claim?
+   - Look for off-by-one errors, inverted conditions, unhandled None/null
+     values, wrong default arguments and missing return statements.
+   - Check that loops terminate, that early returns do not skip cleanup and
+     that exceptions are not silently swallowed.
+   - Confirm that changed function signatures are updated at every call site
+     visible in the diff.
+
+2. Security
+   - Flag hard-coded secrets, tokens, passwords or private keys, including
+     ones that look like test fixtures.
+   - Flag SQL, shell or template strings built from user input without
+     parameterization or escaping.
+   - Flag unsafe deserialization (pickle, yaml.load, eval, exec) and paths
+     built from user input without normalization.
+   - Flag disabled TLS verification, overly broad CORS settings, permissive
+     file modes and new endpoints that skip authentication or authorization.
+   - Note secrets or personal data written to logs.
+
+3. Reliability
+   - Network, disk and subprocess calls should have timeouts and sensible
+     error handling.
+   - Resources (files, sockets, locks, database connections) should be
+     released on every path, ideally through context managers.
+   - Shared state touched from threads or async tasks should be protected.
+   - Retries should be bounded and back off instead of hammering a service.
+
+4. Performance
+   - Point out work repeated inside loops that could be hoisted, N+1 query
+     or request patterns, unbounded memory growth and blocking calls inside
+     async code.
+   - Only raise performance concerns that matter at realistic input sizes.
+
+5. Maintainability
+   - Names should describe intent; functions should do one thing.
+   - Flag dead code, commented-out blocks, leftover debug prints, duplicated
+     logic and magic numbers that deserve a named constant.
+   - New behavior should follow the conventions already used in the
+     surrounding files rather than introducing a parallel style.
+
+6. Tests and Documentation
+   - Behavior changes should come with tests when the project has a test
+     suite; note missing coverage for edge cases the diff introduces.
+   - Public interfaces, configuration options and environment variables that
+     change should be reflected in the README or docstrings.
+
+7. Issue Alignment
+   - Compare the diff against the PR description and any linked issue.
+   - Call out scope creep (unrelated changes bundled in) and requirements
+     from the description that the diff does not address.
+
+8. Dependencies and Configuration
+   - New third-party dependencies should be justified, pinned consistently
+     with the rest of the project and actively maintained.
+   - Flag dependency upgrades that skip a major version without the code
+     changes that upgrade usually requires.
+   - Configuration defaults should be safe; new settings should fail loudly
+     when required values are missing instead of falling back silently.
+
+**Verdict Guidelines:**
+- "Good Push": the change is correct, safe and aligned with its description.
+  Minor style nits or optional improvements do not make a push bad.
+- "Bad Push": the change introduces a bug, a security risk, data loss, a
+  breaking change without migration, or clearly fails to do what it claims.
+- When the diff is truncated, judge only the visible part and say so in the
+  summary.
+
+**Style of the Critique:**
+- Be direct and specific. Reference file names and, where possible, the
+  changed lines.
+- Prefer one precise sentence over a paragraph of hedging.
+- Keep each bullet focused on a single finding.
+- If a single section has nothing worth reporting, write "None." for it; when
+  there are no findings at all, use "No issues found." as described above.
+- Never invent file names, functions or line numbers that are not in the
+  diff.
+
+**Example Output:**
+**Verdict:** Bad Push
+
+**Summary:**
+Adds retry logic to the upload client but swallows every exception, so
+failed uploads are reported as successful.
+
+**Critique:**
+*   **Bad Practices:** `upload()` catches bare `Exception` and returns `True`; the API key is logged at INFO level.
+*   **Issue Alignment:** Addresses the flaky upload issue, but the retry loop has no upper bound.
+*   **Improvements:** Catch only transport errors, cap retries at 3 with backoff, and drop the key from the log line.
+"""
+
+CACHED_REVIEW_INSTRUCTIONS = PR_REVIEW_INSTRUCTIONS + PR_REVIEW_RUBRIC
+
+CHAT_INSTRUCTIONS = """
+You are a helpful AI Assistant integrated with GitHub and Web Search.
+
+Answer the user.
+- Use the search results if available to provide up-to-date information.
+- If they asked about issues, summarize them.
+- If they asked about code, write code.
+"""
+
+# Dynamic suffixes appended after the static instructions above
+MAX_DIFF_CHARS = 30000
+# Review budget for the diff, estimated locally so prompts stay deterministic for caching
+MAX_DIFF_TOKENS = 12000
+CHARS_PER_TOKEN = 4
+
+PR_CONTEXT_TEMPLATE = """
+
+**Context:**
+Repo: {repo}
+PR Title: {title}
+PR Description: {body}
+
+**Omitted From Diff:** {omitted}
+
+**Code Changes (Diff):**
+```
+{diff}
+```
+"""
+
+CHAT_CONTEXT_TEMPLATE = """
+
+**Chat History:**
+{history}
+
+**Context Information (if any):**
+{context}
+
+**Current User Query:** {query}
+"""
+
+SEARCH_SUMMARY_TEMPLATE = "Summarize these search results for the query '{query}':\n\n{results}"
+
+# Interactive calls ("priority") go straight to Gemini; background calls
+# ("standard") share a few slots so they can't crowd out chat replies.
+GEMINI_STANDARD_SLOTS = asyncio.Semaphore(2)
+
+async def call_gemini(prompt, tier="priority", gen_model=None):
+    """Runs a non-batch Gemini request on the given in-process tier."""
+    gen_model = gen_model or model
+    if tier == "priority":
+        response = await gen_model.generate_content_async(prompt)
+    elif tier == "standard":
+        async with GEMINI_STANDARD_SLOTS:
+            response = await gen_model.generate_content_async(prompt)
+    else:
+        raise ValueError(f"Unknown Gemini tier: {tier}")
+    log_cache_usage(response)
+    return response
+
+def log_cache_usage(response):
+    """Logs how much of the prompt was served from Gemini's implicit cache."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        cached = getattr(usage, "cached_content_token_count", 0)
+        logger.info(f"Gemini tokens: prompt={usage.prompt_token_count}, cached={cached}")
 
 # --- Core Logic ---
 
-async def analyze_pr_content(pr, diff_content):
-    issue_context = pr.body if pr.body else "No linked issue found."
-    
-    prompt = f"""
-    You are a strict Senior Software Engineer reviewing a Pull Request.
-    
-    **Context:**
-    Repo: {pr.base.repo.full_name}
-    PR Title: {pr.title}
-    PR Description: {issue_context}
-    
-    **Code Changes (Diff):**
-    ```
-    {diff_content[:30000]} 
-    ```
-    
-    **Task:**
-    Analyze the changes. Determine if this is a "Good Push" or "Bad Push".
-    
-    **Output Format (Markdown):**
-    **Verdict:** [Good Push / Bad Push]
-    
-    **Summary:**
-    [1-2 sentences]
-    
-    **Critique:**
-    *   **Bad Practices:** [Security risks, dirty code, anti-patterns]
-    *   **Issue Alignment:** [Does this solve the problem?]
-    *   **Improvements:** [Specific suggestions]    
-    
-    If it's a perfect push, explicitly state "No issues found."
+NOISY_DIFF_PATH_RE = re.compile(r'(package-lock\.json|yarn\.lock|\.min\.(js|css)|\.pb\.go|\.lock)$|(^|/)vendor/')
+DIFF_FILE_SPLIT_RE = re.compile(r'^(?=diff --git )', re.MULTILINE)
+DIFF_HUNK_SPLIT_RE = re.compile(r'^(?=@@ )', re.MULTILINE)
+# Lines longer than this are almost always minified or generated
+MAX_DIFF_LINE_CHARS = 500
+
+def filter_diff(diff_content):
+    """Drops lockfile, generated, minified and binary noise from a unified diff.
+
+    Denylisted paths and binary patches are dropped as whole files; otherwise
+    only the hunks whose added or removed lines look minified are dropped.
+    Returns the remaining diff and descriptions of what was dropped.
+    """
+    kept, dropped = [], []
+    for section in DIFF_FILE_SPLIT_RE.split(diff_content):
+        if not section.startswith("diff --git "):
+            kept.append(section)
+            continue
+        path = diff_section_path(section)
+        if NOISY_DIFF_PATH_RE.search(path) or "\nBinary files " in section or "\nGIT binary patch" in section:
+            dropped.append(path)
+            continue
+        header, *hunks = DIFF_HUNK_SPLIT_RE.split(section)
+        clean = [hunk for hunk in hunks if not has_minified_lines(hunk)]
+        if hunks and not clean:
+            dropped.append(path)
+            continue
+        if len(clean) < len(hunks):
+            dropped.append(f"{path} ({len(hunks) - len(clean)} of {len(hunks)} hunks)")
+        kept.append(header + "".join(clean))
+    return "".join(kept), dropped
+
+def has_minified_lines(hunk):
+    """Whether any added or removed line of a hunk is too long to be hand-written."""
+    return any(
+        len(line) > MAX_DIFF_LINE_CHARS and line[:1] in "+-"
+        for line in hunk.splitlines()[1:]
+    )
+
+def diff_section_path(section):
+    return section.split("\n", 1)[0].rsplit(" b/", 1)[-1]
+
+def trim_diff(diff_content, max_chars):
+    """Fits a diff into max_chars by whole files and hunks instead of cutting mid-line.
+
+    Files that don't fit keep as many leading hunks as do, and later smaller
+    files can still fill the remaining budget. When not even a file's first
+    hunk fits, that hunk is cut at a line boundary to fill what is left.
+    Returns the trimmed diff and the paths of files that were shortened or
+    left out.
     """
+    if len(diff_content) <= max_chars:
+        return diff_content, []
+    kept, trimmed, used = [], [], 0
+    for section in DIFF_FILE_SPLIT_RE.split(diff_content):
+        if used + len(section) <= max_chars:
+            kept.append(section)
+            used += len(section)
+            continue
+        if not section.startswith("diff --git "):
+            continue
+        trimmed.append(diff_section_path(section))
+        header, *hunks = DIFF_HUNK_SPLIT_RE.split(section)
+        part = header
+        for hunk in hunks:
+            room = max_chars - used - len(part)
+            if len(hunk) > room:
+                if part == header and room > 0:
+                    # Keep at least the hunk header and one whole line
+                    cut = hunk.rfind("\n", 0, room) + 1
+                    if cut > hunk.find("\n") + 1:
+                        part += hunk[:cut]
+                break
+            part += hunk
+        if part != header:
+            kept.append(part)
+            used += len(part)
+    return "".join(kept), trimmed
+
+@dataclass(frozen=True)
+class PullRequest:
+    """The fields of a GitHub PR the reviewer needs, without the rest of the API payload."""
+    repo: str
+    number: int
+    title: str
+    body: str
+    html_url: str
+    api_url: str
+    head_sha: str
+
+    @classmethod
+    def from_api(cls, data):
+        return cls(
+            repo=data["base"]["repo"]["full_name"],
+            number=data["number"],
+            title=data["title"],
+            body=data["body"] or "",
+            html_url=data["html_url"],
+            api_url=data["url"],
+            head_sha=data["head"]["sha"],
+        )
+
+def build_pr_context(pr, diff_content):
+    """Builds the per-PR part of the review prompt."""
+    issue_context = pr.body if pr.body else "No linked issue found."
+    diff_content, dropped = filter_diff(diff_content)
+    diff_content, trimmed = trim_diff(diff_content, MAX_DIFF_TOKENS * CHARS_PER_TOKEN)
+    omitted = []
+    if dropped:
+        omitted.append(f"lockfile, generated, minified or binary changes in {len(dropped)} file(s): {', '.join(dropped)}")
+    if trimmed:
+        omitted.append(f"{len(trimmed)} file(s) shortened or left out to fit the size limit: {', '.join(trimmed)}")
+    return PR_CONTEXT_TEMPLATE.format_map({
+        "repo": pr.repo,
+        "title": pr.title,
+        "body": issue_context,
+        "omitted": "; ".join(omitted) or "None",
+        "diff": diff_content,
+    })
+
+
+# --- Explicit Review Cache ---
+# When enabled, the review instructions live in a Gemini CachedContent and
+# only the per-PR context is sent with each request.
+review_cache = None
+review_model = None
+
+async def refresh_review_cache():
+    """Creates the cached review instructions, or extends their TTL if they already exist."""
+    global review_cache, review_model
     try:
-        response = await asyncio.to_thread(model.generate_content, prompt)
-        return response.text
+        if review_cache:
+            await asyncio.to_thread(review_cache.update, ttl=GEMINI_CACHE_TTL)
+            return
+        review_cache = await asyncio.to_thread(
+            caching.CachedContent.create,
+            model=GEMINI_CACHE_MODEL,
+            display_name="pr-review-instructions",
+            system_instruction=CACHED_REVIEW_INSTRUCTIONS,
+            ttl=GEMINI_CACHE_TTL,
+        )
+        review_model = genai.GenerativeModel.from_cached_content(cached_content=review_cache)
+        logger.info(f"Created Gemini context cache {review_cache.name}")
+    except Exception as e:
+        # Fall back to full prompts; the next refresh tries to create a new cache
+        logger.error(f"Gemini context cache unavailable: {e}")
+        review_cache = review_model = None
+
+# PR reviews keyed by a hash of their per-PR context. Title, description and diff
+# fully determine the review, so a rebased or re-pushed identical diff is free.
+ANALYSIS_CACHE = OrderedDict()
+ANALYSIS_CACHE_SIZE = 512
+
+def prompt_hash(prompt):
+    return hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+
+def get_cached_analysis(key):
+    if key in ANALYSIS_CACHE:
+        ANALYSIS_CACHE.move_to_end(key)
+        return ANALYSIS_CACHE[key]
+    return None
+
+def cache_analysis(key, analysis):
+    ANALYSIS_CACHE[key] = analysis
+    ANALYSIS_CACHE.move_to_end(key)
+    if len(ANALYSIS_CACHE) > ANALYSIS_CACHE_SIZE:
+        ANALYSIS_CACHE.popitem(last=False)
+
+async def embed_diff(diff_content):
+    """Returns a unit-length embedding of the reviewable part of a diff, or None on failure."""
+    try:
+        result = await genai.embed_content_async(
+            model=EMBEDDING_MODEL,
+            content=filter_diff(diff_content)[0][:MAX_DIFF_CHARS],
+        )
+    except Exception as e:
+        logger.warning(f"Embedding failed, skipping semantic cache: {e}")
+        return None
+    vector = result["embedding"]
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+async def analyze_pr_content(pr, diff_content, tier="priority"):
+    context = build_pr_context(pr, diff_content)
+    key = prompt_hash(context)
+    cached = get_cached_analysis(key)
+    if cached is not None:
+        logger.info(f"Reusing cached analysis for {pr_key(pr)}")
+        return cached
+
+    repo_name = pr.repo
+    embedding = await embed_diff(diff_content) if ENABLE_SEMANTIC_CACHE else None
+    if embedding:
+        similar = find_similar_analysis(repo_name, embedding)
+        if similar is not None:
+            logger.info(f"Reusing analysis of a near-identical diff for {pr_key(pr)}")
+            return similar
+
+    try:
+        if review_model:
+            response = await call_gemini(context, tier, review_model)
+        else:
+            response = await call_gemini(PR_REVIEW_INSTRUCTIONS + context, tier)
+        # Raises ValueError when the response was blocked
+        text = response.text
     except Exception as e:
         logger.error(f"Gemini API Error: {e}")
         return "Error analyzing PR with AI."
+    cache_analysis(key, text)
+    if embedding:
+        store_analysis_embedding(repo_name, pr_key(pr), embedding, text)
+    return text
+
+def pr_key(pr):
+    return f"{pr.repo}#{pr.number}"
+
+def format_analysis(pr, analysis):
+    return f"**PR Analysis: {pr.repo}**\n[#{pr.number}: {pr.title}]({pr.html_url})\n\n{analysis}"
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Splits text into Telegram-sized chunks, preferring line breaks."""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    chunks.append(text)
+    return chunks
+
+async def send_analysis(bot, chat_id, msg):
+    for i, chunk in enumerate(split_message(msg)):
+        if i:
+            await asyncio.sleep(0.5)
+        try:
+            await bot.send_message(chat_id=chat_id, text=chunk, parse_mode="Markdown")
+        except Exception as e:
+            logger.warning(f"Markdown failed, sending plain text: {e}")
+            await bot.send_message(chat_id=chat_id, text=chunk)
+
+async def process_pr(session, gh_sem, llm_sem, pr, state, bot, chat_id, tier, batch=None):
+    """Analyzes a single PR if its head commit hasn't been reviewed yet.
+
+    When `batch` is a list the prompt is queued there instead of being sent
+    to Gemini right away.
+    """
+    pr_id = pr_key(pr)
+    last_commit = pr.head_sha
+
+    if state.get(pr_id) == last_commit or (pr_id, last_commit) in PENDING_BATCH_PRS:
+        return False
+
+    try:
+        async with gh_sem:
+            diff_content = await fetch_text(session, pr.api_url, headers=DIFF_HEADERS)
+    except httpx.HTTPError as e:
+        logger.error(f"Could not fetch diff for {pr_id}: {e}")
+        return True
+
+    if batch is not None:
+        context = build_pr_context(pr, diff_content)
+        key = prompt_hash(context)
+        if get_cached_analysis(key) is None:
+            batch.append({
+                "pr_id": pr_id,
+                "sha": last_commit,
+                "header": format_analysis(pr, ""),
+                "prompt": CACHED_REVIEW_INSTRUCTIONS + context,
+                "key": key,
+            })
+            return True
+
+    async with llm_sem:
+        analysis = await analyze_pr_content(pr, diff_content, tier)
+    await send_analysis(bot, chat_id, format_analysis(pr, analysis))
+
+    mark_reviewed(pr_id, last_commit)
+    return True
+
+async def process_repo(session, gh_sem, llm_sem, repo_name, state, bot, chat_id, tier, batch=None):
+    """Lists a repo's open PRs and processes them concurrently."""
+    logger.info(f"Checking {repo_name}...")
+    url = f"{GITHUB_API}/repos/{repo_name}/pulls"
+    etag = get_etag(url)
+    async with gh_sem:
+        resp = await session.get(url, params={"state": "open", "per_page": 100}, headers={"If-None-Match": etag} if etag else None)
+    if resp.status_code == 304:
+        # Conditional requests that hit don't count against the rate limit
+        logger.info(f"No PR changes in {repo_name}")
+        return False
+    resp.raise_for_status()
+
+    pages = resp.json()
+    next_url = resp.links.get("next", {}).get("url")
+    if next_url:
+        async with gh_sem:
+            pages += await fetch_all_pages(session, next_url)
+    open_prs = [PullRequest.from_api(data) for data in pages]
+
+    results = await asyncio.gather(*[process_pr(session, gh_sem, llm_sem, pr, state, bot, chat_id, tier, batch) for pr in open_prs])
+
+    # Only trust the ETag once every listed PR has been reviewed, otherwise a
+    # failed diff fetch or pending batch would be skipped on the next check.
+    # It also only covers the first page, so multi-page lists are never cached.
+    if not next_url and "ETag" in resp.headers and all(state.get(pr_key(pr)) == pr.head_sha for pr in open_prs):
+        save_etag(url, resp.headers["ETag"])
+    return any(results)
+
+# --- Batch Analysis ---
+# (pr_id, sha) pairs submitted to a batch job that hasn't finished yet
+PENDING_BATCH_PRS = set()
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+async def enqueue_pr_batch(items, chat_id):
+    """Submits PR prompts as one Gemini batch job and schedules polling for it."""
+    inline_requests = [{"contents": [{"role": "user", "parts": [{"text": item["prompt"]}]}]} for item in items]
+    job = await batch_client.aio.batches.create(
+        model=GEMINI_BATCH_MODEL,
+        src=inline_requests,
+        config={"display_name": f"pr-review-{datetime.now():%Y%m%d-%H%M}"},
+    )
+    logger.info(f"Submitted batch {job.name} with {len(items)} PRs")
+
+    pending = []
+    for item in items:
+        PENDING_BATCH_PRS.add((item["pr_id"], item["sha"]))
+        pending.append({"pr_id": item["pr_id"], "sha": item["sha"], "header": item["header"], "key": item["key"]})
+    scheduler.add_job(poll_pr_batch, 'interval', minutes=BATCH_POLL_MINUTES, id=job.name, jobstore="batches", args=[job.name, pending, chat_id])
+
+def restore_pending_batches():
+    """Marks PRs in batch jobs persisted from a previous run as pending, so they aren't submitted twice."""
+    for job in scheduler.get_jobs(jobstore="batches"):
+        if batch_client is None:
+            logger.warning(f"Dropping poll for batch {job.id}: GEMINI_BATCH_MODEL is no longer set")
+            job.remove()
+            continue
+        for item in job.args[1]:
+            PENDING_BATCH_PRS.add((item["pr_id"], item["sha"]))
+
+async def poll_pr_batch(job_name, pending, chat_id):
+    """Checks a batch job and delivers the analyses once it has finished."""
+    try:
+        job = await batch_client.aio.batches.get(name=job_name)
+    except Exception as e:
+        logger.error(f"Could not poll batch {job_name}: {e}")
+        return
+
+    if job.state.name not in BATCH_DONE_STATES:
+        return
+    scheduler.remove_job(job_name)
+    for item in pending:
+        # A newer push of the same PR may be pending in a later batch; leave that one alone
+        PENDING_BATCH_PRS.discard((item["pr_id"], item["sha"]))
+
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        logger.error(f"Batch {job_name} ended with {job.state.name}; PRs will be retried next check")
+        return
+
+    for item, inline in zip(pending, job.dest.inlined_responses):
+        if not inline.response:
+            logger.error(f"Batch analysis failed for {item['pr_id']}: {inline.error}")
+            continue
+        # google-genai returns None text for a blocked candidate
+        text = inline.response.text
+        if not text:
+            logger.error(f"Batch analysis for {item['pr_id']} returned no text (blocked?)")
+            continue
+        cache_analysis(item["key"], text)
+        await send_analysis(telegram_bot, chat_id, item["header"] + text)
+        mark_reviewed(item["pr_id"], item["sha"])
 
 async def run_pr_check(context: ContextTypes.DEFAULT_TYPE = None, manual_chat_id=None):
     logger.info("Starting PR Check...")
     chat_id = manual_chat_id if manual_chat_id else TELEGRAM_CHAT_ID
-    bot = context.bot if context else Bot(token=TELEGRAM_TOKEN)
+    bot = telegram_bot
     
     try:
         state = load_state()
-        user = await asyncio.to_thread(gh.get_user)
-        
+
         repos_to_scan = []
         if TARGET_REPOS and TARGET_REPOS[0]:
-            for repo_name in TARGET_REPOS:
-                try:
-                    r = await asyncio.to_thread(gh.get_repo, repo_name.strip())
-                    repos_to_scan.append(r)
-                except Exception as e:
-                    logger.error(f"Could not access {repo_name}: {e}")
+            lookups = await asyncio.gather(
+                *[fetch_json(github, f"{GITHUB_API}/repos/{repo_name.strip()}", revalidate=True) for repo_name in TARGET_REPOS],
+                return_exceptions=True,
+            )
+            for repo_name, r in zip(TARGET_REPOS, lookups):
+                if isinstance(r, Exception):
+                    logger.error(f"Could not access {repo_name}: {r}")
+                else:
+                    repos_to_scan.append(r["full_name"])
         else:
-            all_repos = await asyncio.to_thread(user.get_repos, type='owner', sort='updated', direction='desc')
+            all_repos = await fetch_all_pages(github, f"{GITHUB_API}/user/repos", {"type": "owner", "sort": "updated", "direction": "desc"}, revalidate=True)
             for repo in all_repos:
-                if not INCLUDE_PRIVATE and repo.private:
+                if not INCLUDE_PRIVATE and repo["private"]:
                     continue
-                repos_to_scan.append(repo)
+                repos_to_scan.append(repo["full_name"])
+
+        # Scheduled runs are latency-insensitive, so they go through the Batch API
+        # when available and otherwise yield to interactive Gemini traffic
+        tier = "priority" if manual_chat_id else "standard"
+        batch = [] if batch_client and not manual_chat_id else None
+
+        # Every repo and PR is scanned concurrently; these bound how many GitHub
+        # requests (secondary rate limits) and Gemini reviews (quota) run at once
+        gh_sem = asyncio.Semaphore(GITHUB_SCAN_CONCURRENCY)
+        llm_sem = asyncio.Semaphore(GEMINI_SCAN_CONCURRENCY)
+        tasks = [process_repo(github, gh_sem, llm_sem, r, state, bot, chat_id, tier, batch) for r in repos_to_scan]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        if batch:
+            await enqueue_pr_batch(batch, chat_id)
 
         changes_found = False
-        
-        for repo in repos_to_scan:
-            logger.info(f"Checking {repo.full_name}...")
-            open_prs = await asyncio.to_thread(repo.get_pulls, state='open')
-            
-            for pr in open_prs:
-                pr_id = f"{repo.full_name}#{pr.number}"
-                last_commit = pr.head.sha
-                
-                if state.get(pr_id) == last_commit:
-                    continue
-                
+        failed_repos = []
+        for repo_name, result in zip(repos_to_scan, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error checking {repo_name}: {result}")
+                failed_repos.append(repo_name)
+            elif result:
                 changes_found = True
-                await bot.send_message(chat_id=chat_id, text=f"🔎 Analyzing new changes in **{repo.full_name}** PR #{pr.number}...", parse_mode="Markdown")
-                
-                diff_resp = await asyncio.to_thread(requests.get, pr.diff_url)
-                if diff_resp.status_code != 200:
-                    continue
-                    
-                analysis = await analyze_pr_content(pr, diff_resp.text)
-                
-                msg = f"**PR Analysis: {repo.full_name}**\n[#{pr.number}: {pr.title}]({pr.html_url})\n\n{analysis}"
-                try:
-                    await bot.send_message(chat_id=chat_id, text=msg, parse_mode="Markdown")
-                except Exception as e:
-                    logger.warning(f"Markdown failed, sending plain text: {e}")
-                    await bot.send_message(chat_id=chat_id, text=msg)
-                
-                state[pr_id] = last_commit
-                save_state(state)
         
-        if manual_chat_id and not changes_found:
+        if manual_chat_id and failed_repos:
+            await bot.send_message(chat_id=chat_id, text=f"⚠️ Error checking {len(failed_repos)} repo(s): {', '.join(failed_repos)}")
+        elif manual_chat_id and not changes_found:
              await bot.send_message(chat_id=chat_id, text="✅ No new PR updates found.")
              
     except Exception as e:
@@ -199,6 +1152,26 @@ async def run_pr_check(context: ContextTypes.DEFAULT_TYPE = None, manual_chat_id
         if manual_chat_id:
             await bot.send_message(chat_id=chat_id, text=f"⚠️ Error running check: {e}")
 
+# --- Speech Recognition ---
+# Loaded on the first voice note so startup doesn't wait on the model download
+_whisper = None
+_whisper_lock = asyncio.Lock()
+
+async def get_whisper():
+    global _whisper
+    async with _whisper_lock:
+        if _whisper is None:
+            _whisper = await asyncio.to_thread(WhisperModel, WHISPER_MODEL, device="cpu", compute_type="int8")
+            logger.info(f"Loaded Whisper model {WHISPER_MODEL}")
+    return _whisper
+
+def transcribe(whisper, audio):
+    """Decodes a voice note in memory with PyAV and transcribes it, without ffmpeg or temp files."""
+    samples = decode_audio(io.BytesIO(audio), sampling_rate=whisper.feature_extractor.sampling_rate)
+    segments, _ = whisper.transcribe(samples, beam_size=1, vad_filter=True)
+    # Segments are generated lazily, so the join is where the work happens
+    return " ".join(segment.text.strip() for segment in segments)
+
 # --- Bot Handlers ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -211,10 +1184,8 @@ async def check_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Clears the current chat session."""
     chat_id = str(update.effective_chat.id)
-    history = load_history()
-    if chat_id in history:
-        history[chat_id]["current_session"] = []
-        save_history(history)
+    if has_history(chat_id):
+        delete_session(chat_id)
         await update.message.reply_text("🧹 Current chat session cleared!")
     else:
         await update.message.reply_text("Chat history is already empty.")
@@ -226,20 +1197,17 @@ async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     subcommand = context.args[0].lower()
     chat_id = str(update.effective_chat.id)
-    history_data = load_history()
-    
-    if chat_id not in history_data:
-        history_data[chat_id] = {"current_session": [], "saved_sessions": {}}
-    
-    user_data = history_data[chat_id]
 
     if subcommand == "save":
         if len(context.args) < 2:
             await update.message.reply_text("⚠️ Please provide a name to save the session.")
             return
         name = context.args[1]
-        user_data["saved_sessions"][name] = list(user_data["current_session"])
-        save_history(history_data)
+        # Saving an empty session would just delete any existing session by that name
+        if not session_exists(chat_id, CURRENT_SESSION):
+            await update.message.reply_text("⚠️ Nothing to save yet; the current session is empty.")
+            return
+        copy_session(chat_id, CURRENT_SESSION, name)
         await update.message.reply_text(f"💾 Session saved as '{name}'.")
 
     elif subcommand == "load":
@@ -247,9 +1215,8 @@ async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ Please provide a name to load.")
             return
         name = context.args[1]
-        if name in user_data["saved_sessions"]:
-            user_data["current_session"] = list(user_data["saved_sessions"][name])
-            save_history(history_data)
+        if session_exists(chat_id, name):
+            copy_session(chat_id, name, CURRENT_SESSION)
             await update.message.reply_text(f"📂 Loaded session '{name}'.")
         else:
             await update.message.reply_text(f"❌ Session '{name}' not found.")
@@ -259,15 +1226,13 @@ async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ Please provide a name to remove.")
             return
         name = context.args[1]
-        if name in user_data["saved_sessions"]:
-            del user_data["saved_sessions"][name]
-            save_history(history_data)
+        if delete_session(chat_id, name):
             await update.message.reply_text(f"🗑️ Session '{name}' removed.")
         else:
             await update.message.reply_text(f"❌ Session '{name}' not found.")
 
     elif subcommand == "list":
-        sessions = list(user_data["saved_sessions"].keys())
+        sessions = list_sessions(chat_id)
         if sessions:
             msg = "**Saved Sessions:**\n" + "\n".join([f"- {s}" for s in sessions])
             await update.message.reply_text(msg, parse_mode="Markdown")
@@ -285,12 +1250,11 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     query = " ".join(context.args)
     await update.message.chat.send_action(action="typing")
-    results = perform_web_search(query)
+    results = await perform_web_search(query)
     
-    prompt = f"Summarize these search results for the query '{query}':\n\n{results}"
+    prompt = SEARCH_SUMMARY_TEMPLATE.format_map({"query": query, "results": results})
     try:
-        response = await asyncio.to_thread(model.generate_content, prompt)
-        await update.message.reply_text(response.text, parse_mode="Markdown")
+        await stream_reply(update.message, prompt)
     except Exception as e:
         await update.message.reply_text(f"Error summarizing search: {e}")
 
@@ -299,147 +1263,143 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await update.message.chat.send_action(action="record_voice")
         file = await context.bot.get_file(update.message.voice.file_id)
-        
-        # Paths
-        ogg_file = f"voice_{update.effective_chat.id}.ogg"
-        wav_file = f"voice_{update.effective_chat.id}.wav"
-        
-        # Download
-        await file.download_to_drive(ogg_file)
-        
-        # Convert OGG to WAV using Pydub (SpeechRecognition needs WAV)
+        audio = await file.download_as_bytearray()
+
+        whisper = await get_whisper()
         try:
-            audio = AudioSegment.from_ogg(ogg_file)
-            audio.export(wav_file, format="wav")
-        except Exception as conv_err:
-            logger.error(f"Audio conversion failed: {conv_err}")
-            await update.message.reply_text("⚠️ Could not process audio format. Install ffmpeg?")
-            if os.path.exists(ogg_file): os.remove(ogg_file)
+            text = await asyncio.to_thread(transcribe, whisper, audio)
+        except av.error.FFmpegError as decode_err:
+            logger.error(f"Audio decoding failed: {decode_err}")
+            await update.message.reply_text("⚠️ Could not process audio format.")
+            return
+        if not text:
+            await update.message.reply_text("🤔 Could not understand audio.")
             return
+        await update.message.reply_text(f"🗣️ *Heard:* \"{text}\"", parse_mode="Markdown")
+
+        # Hand off to text processor
+        await process_text_message(update, context, override_text=text)
 
-        # Transcribe
-        recognizer = sr.Recognizer()
-        with sr.AudioFile(wav_file) as source:
-            audio_data = recognizer.record(source)
-            try:
-                # Uses Google Web Speech API (Free, Unofficial, Good for commands)
-                text = recognizer.recognize_google(audio_data)
-                await update.message.reply_text(f"🗣️ *Heard:* \"{text}\"", parse_mode="Markdown")
-                
-                # Hand off to text processor
-                await process_text_message(update, context, override_text=text)
-                
-            except sr.UnknownValueError:
-                await update.message.reply_text("🤔 Could not understand audio.")
-            except sr.RequestError as e:
-                await update.message.reply_text(f"⚠️ Speech Recognition Error: {e}")
-
-        # Clean up
-        if os.path.exists(ogg_file): os.remove(ogg_file)
-        if os.path.exists(wav_file): os.remove(wav_file)
-        
     except Exception as e:
         logger.error(f"Voice handling error: {e}")
         await update.message.reply_text(f"⚠️ Error processing voice: {e}")
 
+async def stream_reply(message, prompt):
+    """Streams a priority Gemini reply into a placeholder message, editing it as chunks arrive."""
+    bot_msg = await message.reply_text("…")
+    reply_text = shown_text = ""
+    next_edit = 0.0  # Show the first chunk as soon as it arrives
+    flood_until = 0.0
+    try:
+        response = await model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            reply_text += chunk.text
+            # Only the first message's worth is live-edited; the rest is sent once complete
+            visible = reply_text[:TELEGRAM_MESSAGE_LIMIT]
+            if visible != shown_text and time.monotonic() >= next_edit:
+                # A failed progress edit must not lose the reply; the final edit catches up
+                try:
+                    await bot_msg.edit_text(visible)
+                    shown_text = visible
+                    next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+                except RetryAfter as e:
+                    logger.warning(f"Progress edit throttled for {e.retry_after}s")
+                    next_edit = flood_until = time.monotonic() + e.retry_after
+                except Exception as e:
+                    logger.warning(f"Progress edit failed: {e}")
+                    next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        log_cache_usage(response)
+    except Exception as e:
+        if reply_text:
+            raise
+        logger.warning(f"Streaming failed, falling back to a single reply: {e}")
+        response = await call_gemini(prompt, tier="priority")
+        reply_text = response.text
+
+    # Render the final text as Markdown once it is complete
+    if flood_until > time.monotonic():
+        await asyncio.sleep(flood_until - time.monotonic())
+    first, *rest = split_message(reply_text)
+    try:
+        await bot_msg.edit_text(first, parse_mode="Markdown")
+    except Exception:
+        if first != shown_text:
+            await bot_msg.edit_text(first)
+    for part in rest:
+        try:
+            await message.reply_text(part, parse_mode="Markdown")
+        except Exception:
+            await message.reply_text(part)
+    return bot_msg, reply_text
+
+# Keyword intents, each matched in a single case-insensitive pass over the message
+SEARCH_INTENT_RE = re.compile(r"(?:search\s+for|google\s+for|find\s+out\s+about)\s+(.+)", re.IGNORECASE | re.DOTALL)
+ISSUE_INTENT_RE = re.compile(r"issue", re.IGNORECASE)
+
 async def process_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE, override_text=None):
     """Unified logic for text and voice-transcribed input."""
     user_text = override_text if override_text else update.message.text
     chat_id = str(update.effective_chat.id)
     logger.info(f"User message ({chat_id}): {user_text}")
     
-    history_data = load_history()
-    user_data = history_data.get(chat_id, {"current_session": [], "saved_sessions": {}})
-    user_history = user_data["current_session"]
+    user_history = current_session(chat_id)
     
     context_str = ""
     
     # Check for "search" or "google" or "find" intent to auto-search
-    if any(keyword in user_text.lower() for keyword in ["search for", "google for", "find out about"]):
+    search_match = SEARCH_INTENT_RE.search(user_text)
+    if search_match:
         await update.message.chat.send_action(action="typing")
-        search_query = user_text.lower().replace("search for", "").replace("google for", "").replace("find out about", "").strip()
-        search_results = perform_web_search(search_query)
+        search_query = search_match.group(1).strip()
+        search_results = await perform_web_search(search_query)
         context_str += f"**Web Search Results for '{search_query}':**\n{search_results}\n"
 
     # Check for "issue" context
-    if "issue" in user_text.lower():
+    if ISSUE_INTENT_RE.search(user_text):
         try:
             await update.message.chat.send_action(action="typing")
-            user = await asyncio.to_thread(gh.get_user)
-            user_login = user.login
-            found_repo = None
-            words = user_text.split()
-            for word in words:
-                clean_word = word.strip("?,.!:'\"")
-                if "/" in clean_word:
-                    try:
-                        found_repo = await asyncio.to_thread(gh.get_repo, clean_word)
-                        if found_repo: break
-                    except: continue
-                else:
-                    try:
-                        potential_repo_name = f"{user_login}/{clean_word}"
-                        found_repo = await asyncio.to_thread(gh.get_repo, potential_repo_name)
-                        if found_repo: break
-                    except: continue
+            repo_index = await get_repo_index()
+            # Explicit owner/name mentions win over bare words
+            explicit = list(dict.fromkeys(
+                m.lower().rstrip(".-").removesuffix(".git") for m in REPO_SLUG_RE.findall(user_text)
+            ))
+            found_repo = next((repo_index[w] for w in explicit if w in repo_index), None)
+            if not found_repo and explicit:
+                # Not one of ours, but may still be a public repo
+                found_repo = await find_first_repo(explicit[:MAX_REPO_CANDIDATES])
+            if not found_repo:
+                words = (w.strip(".-") for w in REPO_TOKEN_RE.findall(user_text.lower()))
+                found_repo = next((repo_index[w] for w in words if w in repo_index), None)
             
             if found_repo:
-                issues = await asyncio.to_thread(found_repo.get_issues, state='open')
-                def get_issues_summary():
-                    summary = []; count = 0
-                    for i in issues:
-                        if count >= 10: break
-                        summary.append(f"- #{i.number}: {i.title}")
-                        count += 1
-                    return "\n".join(summary)
-                issue_list = await asyncio.to_thread(get_issues_summary)
-                context_str += f"**Open Issues in {found_repo.full_name}:**\n{issue_list}\n"
+                issues = await fetch_json(github, f"{GITHUB_API}/repos/{found_repo}/issues", {"state": "open", "per_page": 10})
+                issue_list = "\n".join(f"- #{i['number']}: {i['title']}" for i in issues)
+                context_str += f"**Open Issues in {found_repo}:**\n{issue_list}\n"
         except Exception as e:
             logger.error(f"Failed fetching context: {e}")
 
-    relevant_history = user_history[-10:] 
-    history_str = ""
-    for msg in relevant_history:
-        role = "User" if msg['role'] == 'user' else "Assistant"
-        history_str += f"{role}: {msg['content']}\n"
+    relevant_history = itertools.islice(user_history, max(len(user_history) - 10, 0), None)
+    history_str = "".join(
+        f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}\n" for msg in relevant_history
+    )
 
-    prompt = f"""
-    You are a helpful AI Assistant integrated with GitHub and Web Search.
-    
-    **Chat History:**
-    {history_str}
-    
-    **Current User Query:** {user_text}
-    
-    **Context Information (if any):**
-    {context_str}
-    
-    Answer the user. 
-    - Use the search results if available to provide up-to-date information.
-    - If they asked about issues, summarize them.
-    - If they asked about code, write code. 
-    """
+    prompt = CHAT_INSTRUCTIONS + CHAT_CONTEXT_TEMPLATE.format_map({
+        "history": history_str,
+        "context": context_str,
+        "query": user_text,
+    })
     
     try:
-        response = await asyncio.to_thread(model.generate_content, prompt)
-        reply_text = response.text
-        bot_msg = None
-        try:
-            bot_msg = await update.message.reply_text(reply_text, parse_mode="Markdown")
-        except:
-            bot_msg = await update.message.reply_text(reply_text)
+        bot_msg, reply_text = await stream_reply(update.message, prompt)
             
         # Update and Save History with IDs
         user_msg_id = update.message.message_id
         bot_msg_id = bot_msg.message_id if bot_msg else None
         
-        user_history.append({"role": "user", "content": user_text, "id": user_msg_id})
+        turn = [{"role": "user", "content": user_text, "id": user_msg_id}]
         if bot_msg_id:
-            user_history.append({"role": "assistant", "content": reply_text, "id": bot_msg_id})
-            
-        user_data["current_session"] = user_history[-20:]
-        history_data[chat_id] = user_data
-        save_history(history_data)
+            turn.append({"role": "assistant", "content": reply_text, "id": bot_msg_id})
+        append_messages(chat_id, turn)
     except Exception as e:
         await update.message.reply_text(f"Error getting AI response: {e}")
 
@@ -450,11 +1410,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def clear_all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Wipes chat history and deletes messages from the UI."""
     chat_id = str(update.effective_chat.id)
-    history_data = load_history()
-    
-    if chat_id in history_data:
-        user_data = history_data[chat_id]
-        session_msgs = user_data.get("current_session", [])
+    if has_history(chat_id):
+        session_msgs = list(current_session(chat_id))
         
         # UI Deletion Loop
         deleted_count = 0
@@ -470,8 +1427,7 @@ async def clear_all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     logger.warning(f"Failed to delete msg {msg_id}: {e}")
                     
         # Clear Memory
-        del history_data[chat_id]
-        save_history(history_data)
+        delete_chat(chat_id)
         
         # Update status then delete it after 3s
         try:
@@ -484,6 +1440,16 @@ async def clear_all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("You have no history to clear.")
 
 async def on_startup(application: ApplicationBuilder):
+    global telegram_bot
+    telegram_bot = application.bot
+    # Started only now so persisted batch polls can't fire before there is a bot to
+    # deliver with; due jobs run on the next loop iteration, after the restore below
+    scheduler.start()
+    restore_pending_batches()
+    await _refresh_repo_index_quietly()
+    if ENABLE_GEMINI_CACHE:
+        await refresh_review_cache()
+        scheduler.add_job(refresh_review_cache, 'interval', minutes=55)
     try:
         msg = await application.bot.send_message(chat_id=TELEGRAM_CHAT_ID, text="🟢 AI-PR-Analyzer Online with Web Search & Voice!")
         await asyncio.sleep(5)
@@ -491,12 +1457,21 @@ async def on_startup(application: ApplicationBuilder):
     except Exception as e:
         logger.error(f"Startup error: {e}")
 
+async def on_shutdown(application: ApplicationBuilder):
+    await github.aclose()
+    if review_cache:
+        await asyncio.to_thread(review_cache.delete)
+    await snapshot_history()
+    db.close()
+
 def main():
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(run_pr_check, 'interval', minutes=20)
-    scheduler.start()
+    import_legacy_files()
+    scheduler.add_job(run_pr_check, CronTrigger(hour='7,13,19', minute=0), id='pr_check', replace_existing=True)
+    scheduler.add_job(snapshot_history, 'interval', hours=1)
     
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(on_startup).build()
+    # Queue outbound messages under Telegram's flood limits instead of hitting 429s
+    rate_limiter = AIORateLimiter(overall_max_rate=30, overall_time_period=1, group_max_rate=20, group_time_period=60)
+    application = ApplicationBuilder().token(TELEGRAM_TOKEN).rate_limiter(rate_limiter).post_init(on_startup).post_shutdown(on_shutdown).build()
     
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("check", check_command))
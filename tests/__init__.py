@@ -0,0 +1,12 @@
+import os
+import tempfile
+
+# main.py validates these and opens analyzer.db in the working directory on import
+for name in ("GITHUB_TOKEN", "TELEGRAM_TOKEN", "TELEGRAM_CHAT_ID", "GOOGLE_API_KEY"):
+    os.environ.setdefault(name, "test")
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp())
+try:
+    import main
+finally:
+    os.chdir(_cwd)
@@ -0,0 +1,84 @@
+import unittest
+
+from tests import main
+
+
+def file_diff(path, hunks):
+    """Builds a unified diff for one file, with each hunk given as a list of added lines."""
+    text = f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n"
+    for lines in hunks:
+        text += f"@@ -0,0 +1,{len(lines)} @@\n" + "".join(f"+{line}\n" for line in lines)
+    return text
+
+
+class FilterDiffTest(unittest.TestCase):
+    def test_denylisted_paths_are_dropped_as_files(self):
+        lock = file_diff("package-lock.json", [["{}"]])
+        source = file_diff("app.py", [["x = 1"]])
+        self.assertEqual(main.filter_diff(lock + source), (source, ["package-lock.json"]))
+
+    def test_vendored_paths_are_dropped_as_files(self):
+        vendored = file_diff("vendor/github.com/lib/pq/conn.go", [["package pq"]])
+        nested = file_diff("third_party/vendor/x.js", [["var x"]])
+        source = file_diff("cmd/vendor_check.go", [["package main"]])
+        self.assertEqual(
+            main.filter_diff(vendored + nested + source),
+            (source, ["vendor/github.com/lib/pq/conn.go", "third_party/vendor/x.js"]),
+        )
+
+    def test_only_hunks_with_long_changed_lines_are_dropped(self):
+        long_literal = 'QUERY = "' + "s" * 600 + '"'
+        diff = file_diff("app.py", [["x = 1"], [long_literal], ["y = 2"]])
+        filtered, dropped = main.filter_diff(diff)
+        self.assertIn("+x = 1", filtered)
+        self.assertIn("+y = 2", filtered)
+        self.assertNotIn(long_literal, filtered)
+        self.assertEqual(dropped, ["app.py (1 of 3 hunks)"])
+
+    def test_long_context_lines_are_kept(self):
+        diff = file_diff("app.py", [["x = 1"]]).replace("+x = 1\n", " " + "c" * 600 + "\n+x = 1\n")
+        self.assertEqual(main.filter_diff(diff), (diff, []))
+
+    def test_file_with_only_minified_hunks_is_dropped(self):
+        diff = file_diff("bundle.js", [["a" * 600]])
+        self.assertEqual(main.filter_diff(diff), ("", ["bundle.js"]))
+
+
+class TrimDiffTest(unittest.TestCase):
+    def test_small_diff_is_unchanged(self):
+        diff = file_diff("a.py", [["x = 1"]])
+        self.assertEqual(main.trim_diff(diff, 10_000), (diff, []))
+
+    def test_whole_hunks_are_kept_when_a_file_does_not_fit(self):
+        diff = file_diff("a.py", [["a" * 50], ["b" * 500]])
+        trimmed, paths = main.trim_diff(diff, 200)
+        self.assertEqual(paths, ["a.py"])
+        self.assertIn("a" * 50, trimmed)
+        self.assertNotIn("b" * 10, trimmed)
+
+    def test_single_file_with_huge_first_hunk_is_cut_at_a_line(self):
+        lines = [f"line {i}: " + "x" * 80 for i in range(1500)]
+        diff = file_diff("big.py", [lines])
+        budget = 30_000
+        trimmed, paths = main.trim_diff(diff, budget)
+        self.assertEqual(paths, ["big.py"])
+        self.assertLessEqual(len(trimmed), budget)
+        # Most of the budget is used, and the cut falls on a line boundary
+        self.assertGreater(len(trimmed), budget - 200)
+        self.assertTrue(trimmed.startswith("diff --git a/big.py b/big.py\n"))
+        self.assertTrue(trimmed.endswith("\n"))
+        self.assertIn(trimmed.splitlines()[-1][1:], lines)
+
+    def test_huge_first_hunk_after_other_files_fills_the_remaining_budget(self):
+        small = file_diff("small.py", [["y = 2"]])
+        big = file_diff("big.py", [["z" * 90] * 2000])
+        trimmed, paths = main.trim_diff(small + big, 5_000)
+        self.assertEqual(paths, ["big.py"])
+        self.assertTrue(trimmed.startswith(small))
+        self.assertIn("diff --git a/big.py b/big.py", trimmed)
+        self.assertLessEqual(len(trimmed), 5_000)
+        self.assertGreater(len(trimmed), 5_000 - 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import types
+import unittest
+from unittest import mock
+
+from telegram.error import RetryAfter
+
+from tests import main
+
+
+def make_pr(number=1):
+    return main.PullRequest(
+        repo="o/r", number=number, title="Title", body="", html_url="https://github.com/o/r/pull/1",
+        api_url="https://api.github.com/repos/o/r/pulls/1", head_sha="abc",
+    )
+
+
+class BlockedResponse:
+    @property
+    def text(self):
+        raise ValueError("Invalid operation: the response was blocked")
+
+
+class AnalyzePrContentTest(unittest.IsolatedAsyncioTestCase):
+    async def test_blocked_response_is_reported_not_raised(self):
+        with mock.patch.object(main, "call_gemini", mock.AsyncMock(return_value=BlockedResponse())):
+            analysis = await main.analyze_pr_content(make_pr(), "diff --git a/x b/x\n")
+        self.assertEqual(analysis, "Error analyzing PR with AI.")
+
+    async def test_default_model_gets_the_instructions_without_the_rubric(self):
+        call = mock.AsyncMock(return_value=types.SimpleNamespace(text="**Verdict:** Good Push"))
+        with mock.patch.object(main, "call_gemini", call), mock.patch.object(main, "review_model", None):
+            await main.analyze_pr_content(make_pr(number=7), "diff --git a/y b/y\n")
+        prompt = call.await_args.args[0]
+        self.assertTrue(prompt.startswith(main.PR_REVIEW_INSTRUCTIONS))
+        self.assertNotIn("**Review Rubric:**", prompt)
+
+
+class RunPrCheckTest(unittest.IsolatedAsyncioTestCase):
+    async def test_manual_check_reports_failed_repos(self):
+        bot = mock.AsyncMock()
+        with (
+            mock.patch.object(main, "telegram_bot", bot),
+            mock.patch.object(main, "TARGET_REPOS", ["o/r", "o/ok"]),
+            mock.patch.object(main, "fetch_json", mock.AsyncMock(side_effect=lambda s, url, **kw: {"full_name": url.rsplit("/repos/", 1)[1]})),
+            mock.patch.object(main, "process_repo", mock.AsyncMock(side_effect=[RuntimeError("502 Bad Gateway"), False])),
+        ):
+            await main.run_pr_check(manual_chat_id=42)
+        bot.send_message.assert_awaited_once_with(chat_id=42, text="⚠️ Error checking 1 repo(s): o/r")
+
+
+def inline(text):
+    return types.SimpleNamespace(response=types.SimpleNamespace(text=text), error=None)
+
+
+class PollPrBatchTest(unittest.IsolatedAsyncioTestCase):
+    async def poll(self, pending, responses):
+        job = types.SimpleNamespace(
+            state=types.SimpleNamespace(name="JOB_STATE_SUCCEEDED"),
+            dest=types.SimpleNamespace(inlined_responses=responses),
+        )
+        client = types.SimpleNamespace(aio=types.SimpleNamespace(batches=types.SimpleNamespace(get=mock.AsyncMock(return_value=job))))
+        bot = mock.AsyncMock()
+        with (
+            mock.patch.object(main, "batch_client", client),
+            mock.patch.object(main, "telegram_bot", bot),
+            mock.patch.object(main.scheduler, "remove_job"),
+            mock.patch.object(main, "send_analysis", mock.AsyncMock()) as send,
+            mock.patch.object(main, "mark_reviewed") as mark,
+        ):
+            await main.poll_pr_batch("batches/1", pending, 42)
+        return send, mark
+
+    async def test_blocked_items_are_skipped_and_the_rest_delivered(self):
+        pending = [
+            {"pr_id": "o/r#1", "sha": "a", "header": "PR 1\n", "key": "k1"},
+            {"pr_id": "o/r#2", "sha": "b", "header": "PR 2\n", "key": "k2"},
+        ]
+        send, mark = await self.poll(pending, [inline(None), inline("Looks good.")])
+        send.assert_awaited_once_with(mock.ANY, 42, "PR 2\nLooks good.")
+        mark.assert_called_once_with("o/r#2", "b")
+
+    async def test_newer_pending_sha_of_the_same_pr_is_kept(self):
+        main.PENDING_BATCH_PRS.update({("o/r#3", "old"), ("o/r#3", "new")})
+        self.addCleanup(main.PENDING_BATCH_PRS.clear)
+        await self.poll([{"pr_id": "o/r#3", "sha": "old", "header": "", "key": "k3"}], [inline("ok")])
+        self.assertEqual(main.PENDING_BATCH_PRS, {("o/r#3", "new")})
+
+
+class FakeStream:
+    def __init__(self, parts):
+        self.parts = parts
+        self.usage_metadata = None
+
+    async def __aiter__(self):
+        for part in self.parts:
+            yield types.SimpleNamespace(text=part)
+
+
+class StreamReplyTest(unittest.IsolatedAsyncioTestCase):
+    async def test_failed_progress_edit_still_delivers_the_whole_reply(self):
+        bot_msg = mock.AsyncMock()
+        bot_msg.edit_text.side_effect = [RetryAfter(0), None, None, None]
+        message = mock.AsyncMock()
+        message.reply_text.return_value = bot_msg
+        stream = FakeStream(["Hello ", "world", "!"])
+        with (
+            mock.patch.object(main.model, "generate_content_async", mock.AsyncMock(return_value=stream)),
+            mock.patch.object(main, "STREAM_EDIT_INTERVAL", 0),
+        ):
+            sent, text = await main.stream_reply(message, "prompt")
+        self.assertIs(sent, bot_msg)
+        self.assertEqual(text, "Hello world!")
+        bot_msg.edit_text.assert_awaited_with("Hello world!", parse_mode="Markdown")
+
+
+if __name__ == "__main__":
+    unittest.main()